@@ -62,6 +62,17 @@ def _safe_svd(A, **kwargs):
             raise
 
 
+def _eigh_subset(a, subset_by_index, **kwargs):
+    """Compute the eigenpairs of a symmetric matrix within an index range."""
+    # SciPy 1.5 renamed eigvals to subset_by_index
+    from scipy import linalg
+    if 'subset_by_index' in _get_args(linalg.eigh):
+        kwargs['subset_by_index'] = subset_by_index
+    else:
+        kwargs['eigvals'] = tuple(subset_by_index)
+    return linalg.eigh(a, **kwargs)
+
+
 def _csc_matrix_cast(x):
     from scipy.sparse import csc_matrix
     return csc_matrix(x)
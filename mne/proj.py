@@ -2,23 +2,31 @@
 #
 # License: BSD (3-clause)
 
+import functools
+
 import numpy as np
 
 from .epochs import Epochs
-from .utils import check_fname, logger, verbose, _check_option
+from .fixes import einsum, _eigh_subset
+from .utils import (check_fname, logger, verbose, _check_option,
+                    _get_blas_funcs)
 from .io.open import fiff_open
-from .io.pick import pick_types, pick_types_forward
+from .io.pick import pick_types, pick_types_forward, channel_type
 from .io.proj import (Projection, _has_eeg_average_ref_proj, _read_proj,
                       make_projector, make_eeg_average_ref_proj, _write_proj)
 from .io.write import start_file, end_file
 from .event import make_fixed_length_events
-from .parallel import parallel_func
+from .parallel import parallel_func, check_n_jobs
 from .cov import _check_n_samples
 from .forward import (is_fixed_orient, _subject_from_forward,
                       convert_forward_solution)
 from .source_estimate import _make_stc
 
 
+# Number of samples to process at once when computing data covariances
+_COV_CHUNK = 10000
+
+
 @verbose
 def read_proj(fname, verbose=None):
     """Read projections from a FIF file.
@@ -72,14 +80,22 @@ def write_proj(fname, projs):
         end_file(fid)
 
 
+def _picks_proj(info):
+    """Get the good gradiometer, magnetometer and EEG picks in one pass."""
+    bads = set(info['bads'])
+    picks = dict(grad=[], mag=[], eeg=[])
+    for ii, ch_name in enumerate(info['ch_names']):
+        if ch_name not in bads:
+            ch_type = channel_type(info, ii)
+            if ch_type in picks:
+                picks[ch_type].append(ii)
+    return [np.array(picks[key], int) for key in ('grad', 'mag', 'eeg')]
+
+
 @verbose
 def _compute_proj(data, info, n_grad, n_mag, n_eeg, desc_prefix,
-                  meg='separate', verbose=None):
-    from scipy import linalg
-    grad_ind = pick_types(info, meg='grad', ref_meg=False, exclude='bads')
-    mag_ind = pick_types(info, meg='mag', ref_meg=False, exclude='bads')
-    eeg_ind = pick_types(info, meg=False, eeg=True, ref_meg=False,
-                         exclude='bads')
+                  meg='separate', n_jobs=1, verbose=None):
+    grad_ind, mag_ind, eeg_ind = _picks_proj(info)
 
     _check_option('meg', meg, ['separate', 'combined'])
     if meg == 'combined':
@@ -88,7 +104,7 @@ def _compute_proj(data, info, n_grad, n_mag, n_eeg, desc_prefix,
                              'using meg="combined"')
         kinds = ['meg', '', 'eeg']
         n_mag = 0
-        grad_ind = pick_types(info, meg=True, ref_meg=False, exclude='bads')
+        grad_ind = np.union1d(grad_ind, mag_ind)
         if (n_grad > 0) and len(grad_ind) == 0:
             logger.info("No MEG channels found for joint estimation. "
                         "Forcing n_grad=n_mag=0")
@@ -111,19 +127,18 @@ def _compute_proj(data, info, n_grad, n_mag, n_eeg, desc_prefix,
                                         for ind in [grad_ind, mag_ind,
                                                     eeg_ind])
 
+    blocks = [(n, ind, names, desc) for n, ind, names, desc in zip(
+        [n_grad, n_mag, n_eeg], [grad_ind, mag_ind, eeg_ind],
+        [grad_names, mag_names, eeg_names], kinds) if n > 0]
+    # no need to dispatch to workers that would have nothing to do
+    n_jobs = max(min(check_n_jobs(n_jobs), len(blocks)), 1)
+    # LAPACK releases the GIL, and threads avoid copying the blocks around
+    parallel, p_fun, _ = parallel_func(_eigh_block, n_jobs, prefer='threads')
+    results = parallel(p_fun(_sym_block(data, ind), n)
+                       for n, ind, _, _ in blocks)
+
     projs = []
-    for n, ind, names, desc in zip([n_grad, n_mag, n_eeg],
-                                   [grad_ind, mag_ind, eeg_ind],
-                                   [grad_names, mag_names, eeg_names],
-                                   kinds):
-        if n == 0:
-            continue
-        data_ind = data[ind][:, ind]
-        # data is the covariance matrix: U * S**2 * Ut
-        U, Sexp2, _ = linalg.svd(data_ind, full_matrices=False)
-        U = U[:, :n]
-        exp_var = Sexp2 / Sexp2.sum()
-        exp_var = exp_var[:n]
+    for (_, _, names, desc), (U, exp_var) in zip(blocks, results):
         for k, (u, var) in enumerate(zip(U.T, exp_var)):
             proj_data = dict(col_names=names, row_names=None,
                              data=u[np.newaxis, :], nrow=1, ncol=u.size)
@@ -136,6 +151,34 @@ def _compute_proj(data, info, n_grad, n_mag, n_eeg, desc_prefix,
     return projs
 
 
+def _sym_block(data, ind):
+    """Get the diagonal block of a symmetric matrix, avoiding copies."""
+    # data is symmetric, so the transpose of a C-ordered block holds the same
+    # values and is Fortran-ordered, i.e. usable by LAPACK without a copy
+    ind = np.asarray(ind)
+    if len(ind) > 0 and np.array_equal(ind, np.arange(ind[0], ind[-1] + 1)):
+        sl = slice(ind[0], ind[-1] + 1)
+        block = data[sl, sl]  # a view
+        return block.T if block.flags.c_contiguous else block
+    return data[np.ix_(ind, ind)].T
+
+
+def _eigh_block(data_ind, n):
+    """Compute the top n eigenvectors and explained variances of a block."""
+    # data is the covariance matrix: U * S**2 * Ut, so only the top n
+    # eigenpairs are needed, and its trace is the sum of all of them
+    total_var = np.trace(data_ind)
+    # by Cauchy-Schwarz any non-finite entry of a covariance shows up on its
+    # diagonal, so checking the trace is enough to skip LAPACK's own check
+    if not np.isfinite(total_var):
+        raise ValueError('data must not contain infs or NaNs')
+    n_ind = len(data_ind)
+    n = min(n, n_ind)
+    Sexp2, U = _eigh_subset(data_ind, [n_ind - n, n_ind - 1],
+                            overwrite_a=True, check_finite=False)
+    return U[:, ::-1], Sexp2[::-1] / total_var
+
+
 @verbose
 def compute_proj_epochs(epochs, n_grad=2, n_mag=2, n_eeg=2, n_jobs=1,
                         desc_prefix=None, meg='separate', verbose=None):
@@ -154,7 +197,7 @@ def compute_proj_epochs(epochs, n_grad=2, n_mag=2, n_eeg=2, n_jobs=1,
     n_eeg : int
         Number of vectors for EEG channels.
     %(n_jobs)s
-        Number of jobs to use to compute covariance.
+        Number of jobs to use to compute covariance and projection vectors.
     desc_prefix : str | None
         The description prefix to use. If None, one will be created based on
         the event_id, tmin, and tmax.
@@ -188,26 +231,76 @@ def compute_proj_epochs(epochs, n_grad=2, n_mag=2, n_eeg=2, n_jobs=1,
     if desc_prefix is None:
         desc_prefix = "%s-%-.3f-%-.3f" % (event_id, epochs.tmin, epochs.tmax)
     return _compute_proj(data, epochs.info, n_grad, n_mag, n_eeg, desc_prefix,
-                         meg=meg)
+                         meg=meg, n_jobs=n_jobs)
 
 
 def _compute_cov_epochs(epochs, n_jobs):
     """Compute epochs covariance."""
-    parallel, p_fun, _ = parallel_func(np.dot, n_jobs)
-    data = parallel(p_fun(e, e.T) for e in epochs)
-    n_epochs = len(data)
+    parallel, p_fun, n_jobs = parallel_func(_xxT_batch, n_jobs)
+    n_chan, n_samples = epochs.info['nchan'], len(epochs.times)
+    batches = _iter_epoch_batches(epochs, max(_COV_CHUNK // n_samples, 1))
+    if n_jobs == 1:
+        # accumulate in place rather than keeping each batch product around
+        data = None
+        n_epochs = 0
+        for n, x in batches:
+            data = _xxT(x, data)
+            n_epochs += n
+    else:
+        out = parallel(p_fun(n, x) for n, x in batches)
+        n_epochs = sum(n for n, _ in out)
+        if n_epochs > 0:
+            data = functools.reduce(np.add, (d for _, d in out))
     if n_epochs == 0:
         raise RuntimeError('No good epochs found')
 
-    n_chan, n_samples = epochs.info['nchan'], len(epochs.times)
     _check_n_samples(n_samples * n_epochs, n_chan)
-    data = sum(data)
-    return data
+    return _symmetrize_lower(data)
+
+
+def _iter_epoch_batches(epochs, n_batch):
+    """Iterate over batches of epochs concatenated in time."""
+    # sum_i e_i @ e_i.T == x @ x.T for x = [e_1, e_2, ...], so batching
+    # epochs gives fewer, larger (and more efficient) SYRK calls
+    batch = list()
+    for e in epochs:
+        batch.append(e)
+        if len(batch) == n_batch:
+            yield len(batch), np.concatenate(batch, axis=1)
+            batch = list()
+    if len(batch) > 0:
+        yield len(batch), np.concatenate(batch, axis=1)
+
+
+def _xxT_batch(n, x):
+    """Compute x @ x.T for a batch of n epochs (see _xxT)."""
+    return n, _xxT(x)
+
+
+def _xxT(x, out=None):
+    """Compute x @ x.T (added to out) with a symmetric rank-k update.
+
+    Only the lower triangle of the result is computed, see
+    :func:`_symmetrize_lower`.
+    """
+    # SYRK does half the work of GEMM, and x.T is Fortran-ordered for
+    # C-ordered x so it does not need to be copied
+    syrk = _get_blas_funcs(x.dtype, 'syrk')
+    if out is None:
+        return syrk(1., x.T, trans=1, lower=1)
+    return syrk(1., x.T, beta=1., c=out, trans=1, lower=1, overwrite_c=1)
+
+
+def _symmetrize_lower(c):
+    """Fill the upper triangle of a matrix from its lower triangle."""
+    i_upper = np.triu_indices(len(c), 1)
+    c[i_upper] = c.T[i_upper]
+    return c
 
 
 @verbose
 def compute_proj_evoked(evoked, n_grad=2, n_mag=2, n_eeg=2, desc_prefix=None,
-                        meg='separate', verbose=None):
+                        meg='separate', n_jobs=1, verbose=None):
     """Compute SSP (signal-space projection) vectors on evoked data.
 
     %(compute_ssp)s
@@ -234,6 +327,10 @@ def compute_proj_evoked(evoked, n_grad=2, n_mag=2, n_eeg=2, desc_prefix=None,
         projectors computed for MEG will be ``n_mag``.
 
         .. versionadded:: 0.18
+    %(n_jobs)s
+        Number of jobs to use to compute the projection vectors.
+
+        .. versionadded:: 0.23
     %(verbose)s
 
     Returns
@@ -245,11 +342,11 @@ def compute_proj_evoked(evoked, n_grad=2, n_mag=2, n_eeg=2, desc_prefix=None,
     --------
     compute_proj_raw, compute_proj_epochs
     """
-    data = np.dot(evoked.data, evoked.data.T)  # compute data covariance
+    data = _symmetrize_lower(_xxT(evoked.data))  # compute data covariance
     if desc_prefix is None:
         desc_prefix = "%-.3f-%-.3f" % (evoked.times[0], evoked.times[-1])
     return _compute_proj(data, evoked.info, n_grad, n_mag, n_eeg, desc_prefix,
-                         meg=meg)
+                         meg=meg, n_jobs=n_jobs)
 
 
 @verbose
@@ -283,7 +380,7 @@ def compute_proj_raw(raw, start=0, stop=None, duration=1, n_grad=2, n_mag=2,
     flat : dict | None
         Epoch flat configuration (see Epochs).
     %(n_jobs)s
-        Number of jobs to use to compute covariance.
+        Number of jobs to use to compute covariance and projection vectors.
     meg : str
         Can be 'separate' (default) or 'combined' to compute projectors
         for magnetometers and gradiometers separately or jointly.
@@ -320,9 +417,13 @@ def compute_proj_raw(raw, start=0, stop=None, duration=1, n_grad=2, n_mag=2,
         start = max(raw.time_as_index(start)[0], 0)
         stop = raw.time_as_index(stop)[0] if stop else raw.n_times
         stop = min(stop, raw.n_times)
-        data, times = raw[:, start:stop]
-        _check_n_samples(stop - start, data.shape[0])
-        data = np.dot(data, data.T)  # compute data covariance
+        _check_n_samples(stop - start, raw.info['nchan'])
+        # compute data covariance, reading the data in chunks to limit memory
+        data = None
+        for first in range(start, stop, _COV_CHUNK):
+            this_data, _ = raw[:, first:min(first + _COV_CHUNK, stop)]
+            data = _xxT(this_data, data)
+        data = _symmetrize_lower(data)
         info = raw.info
         # convert back to times
         start = start / raw.info['sfreq']
@@ -330,7 +431,7 @@ def compute_proj_raw(raw, start=0, stop=None, duration=1, n_grad=2, n_mag=2,
 
     desc_prefix = "Raw-%-.3f-%-.3f" % (start, stop)
     projs = _compute_proj(data, info, n_grad, n_mag, n_eeg, desc_prefix,
-                          meg=meg)
+                          meg=meg, n_jobs=n_jobs)
     return projs
 
 
@@ -366,7 +467,6 @@ def sensitivity_map(fwd, projs=None, ch_type='grad', mode='fixed', exclude=[],
         The sensitivity map as a SourceEstimate or VolSourceEstimate instance
         for visualization.
     """
-    from scipy import linalg
     # check strings
     _check_option('ch_type', ch_type, ['eeg', 'grad', 'mag'])
     _check_option('mode', mode, ['free', 'fixed', 'ratio', 'radiality',
@@ -389,6 +489,12 @@ def sensitivity_map(fwd, projs=None, ch_type='grad', mode='fixed', exclude=[],
                            'mne-python developers')
 
     gain = fwd['sol']['data']
+    n_sensors, n_dipoles = gain.shape
+    n_locations = n_dipoles // 3
+    need_s = mode in ('free', 'ratio', 'radiality')
+    if not need_s:
+        # only the normal components are used, shape (n_sensors, n_locations)
+        gain = np.ascontiguousarray(gain[:, 2::3])
 
     # Make sure EEG has average
     if ch_type == 'eeg':
@@ -413,36 +519,34 @@ def sensitivity_map(fwd, projs=None, ch_type='grad', mode='fixed', exclude=[],
     elif mode in residual_types:
         raise ValueError('No projectors used, cannot compute %s' % mode)
 
-    n_sensors, n_dipoles = gain.shape
-    n_locations = n_dipoles // 3
-    sensitivity_map = np.empty(n_locations)
-
-    for k in range(n_locations):
-        gg = gain[:, 3 * k:3 * (k + 1)]
-        if mode != 'fixed':
-            s = linalg.svd(gg, full_matrices=False, compute_uv=False)
-        if mode == 'free':
-            sensitivity_map[k] = s[0]
-        else:
-            gz = linalg.norm(gg[:, 2])  # the normal component
-            if mode == 'fixed':
-                sensitivity_map[k] = gz
-            elif mode == 'ratio':
-                sensitivity_map[k] = gz / s[0]
-            elif mode == 'radiality':
-                sensitivity_map[k] = 1. - (gz / s[0])
-            else:
-                if mode == 'angle':
-                    co = linalg.norm(np.dot(gg[:, 2], U))
-                    sensitivity_map[k] = co / gz
-                else:
-                    p = linalg.norm(np.dot(proj, gg[:, 2]))
-                    if mode == 'remaining':
-                        sensitivity_map[k] = p / gz
-                    elif mode == 'dampening':
-                        sensitivity_map[k] = 1. - p / gz
-                    else:
-                        raise ValueError('Unknown mode type (got %s)' % mode)
+    if need_s:
+        # the largest singular value of each (n_sensors, 3) block is the
+        # square root of the largest eigenvalue of its 3x3 Gram matrix
+        gain_3 = gain.reshape(n_sensors, n_locations, 3).transpose(1, 0, 2)
+        gram = np.matmul(gain_3.transpose(0, 2, 1), gain_3)
+        s_max = np.sqrt(np.linalg.eigvalsh(gram)[:, -1])
+        gain_z = gain[:, 2::3]
+    else:
+        gain_z = gain
+    if mode != 'free':
+        gz = _col_norms(gain_z)
+    if mode == 'free':
+        sensitivity_map = s_max
+    elif mode == 'fixed':
+        sensitivity_map = gz
+    elif mode == 'ratio':
+        sensitivity_map = gz / s_max
+    elif mode == 'radiality':
+        sensitivity_map = 1. - (gz / s_max)
+    elif mode == 'angle':
+        co = _col_norms(np.dot(U.T, gain_z))
+        sensitivity_map = co / gz
+    else:
+        p = _col_norms(np.dot(proj, gain_z))
+        if mode == 'remaining':
+            sensitivity_map = p / gz
+        else:  # mode == 'dampening'
+            sensitivity_map = 1. - p / gz
 
     # only normalize fixed and free methods
     if mode in ['fixed', 'free']:
@@ -452,3 +556,9 @@ def sensitivity_map(fwd, projs=None, ch_type='grad', mode='fixed', exclude=[],
     vertices = [s['vertno'] for s in fwd['src']]
     return _make_stc(sensitivity_map[:, np.newaxis], vertices, fwd['src'].kind,
                      tmin=0., tstep=1., subject=subject)
+
+
+def _col_norms(x):
+    """Compute the norms of the columns of a 2D array."""
+    # unlike np.linalg.norm, this does not create a squared copy of x
+    return np.sqrt(einsum('ij,ij->j', x, x))
@@ -18,7 +18,7 @@ from mne.io.proj import (make_projector, activate_proj,
                          _needs_eeg_average_ref_proj)
 from mne.preprocessing import maxwell_filter
 from mne.proj import (read_proj, write_proj, make_eeg_average_ref_proj,
-                      _has_eeg_average_ref_proj)
+                      _has_eeg_average_ref_proj, _eigh_block)
 from mne.rank import _compute_rank_int
 from mne.utils import run_tests_if_main
 
@@ -405,4 +405,22 @@ def test_sss_proj():
             assert this_raw.info['projs'][3]['data']['col_names'] == mag_names
 
 
+def test_eigh_block():
+    """Test that the partial eigendecomposition matches the full SVD."""
+    rng = np.random.RandomState(0)
+    data = rng.randn(20, 100)
+    data = np.dot(data, data.T)
+    U, s, _ = linalg.svd(data)
+    for n in (1, 2, 20, 25):
+        n_use = min(n, len(data))
+        U_n, exp_var = _eigh_block(data.copy(order='F'), n)
+        assert U_n.shape == (len(data), n_use)
+        assert_allclose(np.abs(np.sum(U_n * U[:, :n_use], axis=0)), 1.,
+                        rtol=1e-7)
+        assert_allclose(exp_var, (s / s.sum())[:n_use], rtol=1e-7)
+    data[1, 1] = np.nan
+    with pytest.raises(ValueError, match='infs or NaNs'):
+        _eigh_block(data, 2)
+
+
 run_tests_if_main()